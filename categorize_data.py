@@ -1,83 +1,226 @@
-import json
+import mmap
+import orjson
+import os
 import httpx
 import asyncio
-from typing import List, Dict
+from typing import BinaryIO, List, Dict, Optional
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 # Define the Pydantic models (as provided)
 from pydantic import BaseModel, Field
 
+# Maximum number of categorization requests in flight at once. Each request carries
+# BATCH_SIZE LLM calls and the server runs only LLM_MAX_INFLIGHT (16 by default) of them
+# at a time, so more concurrent batches would just queue server-side into read timeouts.
+MAX_CONCURRENCY = int(os.environ.get("CATEGORIZE_MAX_CONCURRENCY", 1))
+# Number of events sent to the batch endpoint per request
+BATCH_SIZE = 32
+# Status codes worth retrying: rate limiting and transient gateway/availability errors.
+# 500 is left out: the server reports every failure as 500, deterministic ones included.
+RETRIABLE_STATUS_CODES = {429, 502, 503, 504}
+
 class CategoryOutput(BaseModel):
     category: str = Field(description="The determined category of the event")
     confidence: float = Field(description="Confidence score (0-1) for the assigned category")
 
-class CategoryInput(BaseModel):
-    title: str
-    description: str
+class CategoryBatchOutput(BaseModel):
+    items: List[Optional[CategoryOutput]]
+
+def is_retriable(exception: BaseException) -> bool:
+    # Only timeouts hit before the request reached the server are retried: after a read or
+    # write timeout the server may still be running the (expensive) batch
+    if isinstance(exception, (httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    return isinstance(exception, httpx.HTTPStatusError) and exception.response.status_code in RETRIABLE_STATUS_CODES
+
+exponential_backoff = wait_exponential_jitter(initial=0.5, max=8)
+
+def wait_for_retry(retry_state) -> float:
+    """
+    Waits as long as the server's Retry-After header asks for, falling back to
+    exponential backoff with jitter.
+    """
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, httpx.HTTPStatusError):
+        retry_after = exception.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+    return exponential_backoff(retry_state)
 
-async def categorize_event(endpoint_url: str, event_data: Dict) -> Dict:
+@retry(stop=stop_after_attempt(5), wait=wait_for_retry, retry=retry_if_exception(is_retriable), reraise=True)
+async def post_batch(
+    client: httpx.AsyncClient, semaphore: asyncio.Semaphore, endpoint_url: str, payload: Dict
+) -> httpx.Response:
+    # The semaphore is released while backing off, so waiting retries don't hold a slot
+    async with semaphore:
+        response = await client.post(
+            endpoint_url,
+            content=orjson.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        )
+    response.raise_for_status()  # Raise an exception for bad status codes
+    return response
+
+async def categorize_events(
+    client: httpx.AsyncClient, semaphore: asyncio.Semaphore, endpoint_url: str, events: List[Dict]
+) -> List[Optional[Dict]]:
     """
-    Calls the categorization endpoint for a single event.
+    Calls the batch categorization endpoint for a chunk of events.
 
     Args:
-        endpoint_url: The URL of the /categorize_event endpoint.
-        event_data: A dictionary containing the 'title' and 'description' of the event.
+        client: A shared httpx.AsyncClient, so connections are reused across chunks.
+        semaphore: Bounds how many requests are in flight against the endpoint.
+        endpoint_url: The URL of the /categorize_events_batch endpoint.
+        events: A list of dictionaries containing the 'title' and 'description' of each event.
 
     Returns:
-        A dictionary containing the 'category' and 'confidence' fields,
-        or None if the categorization fails.
+        A list with one dictionary containing the 'category' field per event,
+        or None entries if the categorization fails after retries.
     """
-    category_input = CategoryInput(title=event_data['title'], description=event_data['description'])
+    # Built as plain dicts: the events come straight from our own file, so there is
+    # no need to validate them client-side; the server validates its input anyway
+    payload = {"items": [{"title": event['title'], "description": event['description']} for event in events]}
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(endpoint_url, json=category_input.model_dump())
-            response.raise_for_status()  # Raise an exception for bad status codes
-            category_output = CategoryOutput(**response.json())
-            return {
-                "category": category_output.category,
-            }
+        response = await post_batch(client, semaphore, endpoint_url, payload)
+        batch_output = CategoryBatchOutput(**orjson.loads(response.content))
+        if len(batch_output.items) != len(events):
+            # Results are matched to events by position, so a short or long reply can't be trusted
+            print(f"Error: expected {len(events)} categories for batch starting with "
+                  f"'{events[0]['title']}', got {len(batch_output.items)}")
+            return [None] * len(events)
+        return [
+            {"category": category_output.category} if category_output is not None else None
+            for category_output in batch_output.items
+        ]
     except httpx.HTTPError as e:
-        print(f"Error categorizing event '{event_data['title']}': {e}")
-        return None
+        print(f"Error categorizing batch of {len(events)} events starting with '{events[0]['title']}': {e}")
+        return [None] * len(events)
     except Exception as e:
-        print(f"An unexpected error occurred while categorizing event '{event_data['title']}': {e}")
-        return None
+        print(f"An unexpected error occurred while categorizing batch of {len(events)} events: {e}")
+        return [None] * len(events)
+
+def load_json(filepath: str) -> Dict:
+    """
+    Parses a JSON file straight from a read-only memory map of it, so the
+    file contents are never copied into an intermediate Python string.
+
+    Args:
+        filepath: The path to the JSON file.
+
+    Returns:
+        The parsed JSON document.
+    """
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return orjson.loads(b"")  # mmap refuses empty files; let orjson report the error
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as buffer:
+                return orjson.loads(buffer)
+
+def write_header(f: BinaryIO, data: Dict):
+    """
+    Writes every top-level field other than "events", then opens the "events" array.
+    """
+    f.write(b"{")
+    for key, value in data.items():
+        if key != "events":
+            f.write(orjson.dumps(key) + b": " + orjson.dumps(value) + b",\n")
+    f.write(b'"events": [')
+
+def write_events(f: BinaryIO, events: List[Dict], written: int) -> int:
+    """
+    Appends events to the open "events" array.
+
+    Args:
+        f: The binary file being written.
+        events: The events to append.
+        written: How many events the array already holds.
+
+    Returns:
+        How many events the array holds afterwards.
+    """
+    for event in events:
+        f.write(b",\n" if written else b"\n")
+        f.write(orjson.dumps(event, option=orjson.OPT_INDENT_2))
+        written += 1
+    return written
 
 async def process_and_update_events(endpoint_url: str, filepath: str):
     """
-    Processes a list of events by calling the categorization endpoint for each
+    Processes a list of events by calling the batch categorization endpoint for
+    each chunk of BATCH_SIZE events (concurrently, over a single pooled client)
     and updates the events in the JSON file with the category information.
 
     Args:
-        endpoint_url: The URL of the /categorize_event endpoint.
+        endpoint_url: The URL of the /categorize_events_batch endpoint.
         filepath: The path to the JSON file (e.g., "data.json").
     """
     try:
-        with open(filepath, "r+", encoding="utf-8") as f:
-            data = json.load(f)
-            events = data.get("events", [])
-            updated_events = []
-            for event in events:
-                category_info = await categorize_event(endpoint_url, event)
-                if category_info:
-                    updated_event = {**event, **category_info}
-                    updated_events.append(updated_event)
-                else:
-                    updated_events.append(event) # Keep the original event if categorization failed
-
-            data["events"] = updated_events
-            f.seek(0)  # Go to the beginning of the file
-            json.dump(data, f, indent=4, ensure_ascii=False)
-            f.truncate() # Remove remaining part if the new content is shorter
+        # File I/O and (de)serialization run in worker threads to keep the event loop free
+        data = await asyncio.to_thread(load_json, filepath)
+        events = data.get("events", [])
+
+        # One pooled client for the whole run; chunks are categorized concurrently,
+        # at most MAX_CONCURRENCY at a time. HTTP/2 is negotiated when the server sits
+        # behind a TLS proxy that speaks it; against plain uvicorn the client falls back
+        # to HTTP/1.1 keep-alive
+        limits = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+        timeout = httpx.Timeout(60.0)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        chunks = [events[i:i + BATCH_SIZE] for i in range(0, len(events), BATCH_SIZE)]
+
+        async def categorize_chunk(index: int, client: httpx.AsyncClient):
+            return index, await categorize_events(client, semaphore, endpoint_url, chunks[index])
+
+        # Events are streamed into a temporary file as their chunks complete and the
+        # file is swapped in atomically, so the original is untouched until the end
+        tmp_filepath = filepath + ".tmp"
+        f = await asyncio.to_thread(open, tmp_filepath, "wb")
+        try:
+            await asyncio.to_thread(write_header, f, data)
+
+            async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
+                tasks = [asyncio.create_task(categorize_chunk(i, client)) for i in range(len(chunks))]
+                try:
+                    completed = {}
+                    next_index = 0
+                    written = 0
+                    for future in asyncio.as_completed(tasks):
+                        index, chunk_result = await future
+                        completed[index] = chunk_result
+                        # Write every chunk that is now contiguous, keeping the original event order
+                        ready = []
+                        while next_index in completed:
+                            for event, category_info in zip(chunks[next_index], completed.pop(next_index)):
+                                # Keep the original event if categorization failed
+                                ready.append({**event, **category_info} if category_info else event)
+                            next_index += 1
+                        if ready:
+                            written = await asyncio.to_thread(write_events, f, ready, written)
+                except BaseException:
+                    # Stop the remaining requests before the client closes under them
+                    for task in tasks:
+                        task.cancel()
+                    raise
+
+            await asyncio.to_thread(f.write, b"\n]}\n")
+        except BaseException:
+            # The original file is untouched; just drop the partial temporary one
+            f.close()
+            os.unlink(tmp_filepath)
+            raise
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.replace, tmp_filepath, filepath)
 
     except FileNotFoundError:
         print(f"Error: {filepath} not found.")
         return
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         print(f"Error: Invalid JSON format in {filepath}.")
         return
 
 async def main():
-    endpoint_url = "http://127.0.0.1:8000/categorize_event"  # Replace with your actual endpoint URL
+    endpoint_url = "http://127.0.0.1:8000/categorize_events_batch"  # Replace with your actual endpoint URL
     json_filepath = "data.json"
 
     await process_and_update_events(endpoint_url, json_filepath)
@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import orjson
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, List, Optional, Protocol, Tuple
+
+import faiss
+import numpy as np
+
+
+class CacheBackend(Protocol):
+    """
+    Minimal async key/value interface used to memoize LLM chain results.
+    """
+
+    async def get(self, key: str) -> Optional[Any]:
+        ...
+
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
+        ...
+
+    async def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        ...
+
+    async def set_many(self, items: List[Tuple[str, Any]], ttl: Optional[int] = None) -> None:
+        ...
+
+
+def template_hash(template: str, schema: Any = None) -> str:
+    """
+    Short fingerprint of a prompt template and, optionally, the pydantic model its
+    output is bound to, so editing either one invalidates previously cached results.
+    """
+    raw = template.encode()
+    if schema is not None:
+        raw += orjson.dumps(schema.model_json_schema(), option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(raw).hexdigest()[:8]
+
+
+def make_cache_key(model: str, seed: int, template_version: str, payload: Any) -> str:
+    """
+    Builds a content-addressed key for a deterministic (temperature=0, fixed seed) chain call.
+
+    Args:
+        model: The name of the model the chain runs on.
+        seed: The sampling seed passed to the model.
+        template_version: A fingerprint of the prompt template, see `template_hash`.
+        payload: The JSON-serializable input passed to the chain.
+
+    Returns:
+        The hex SHA256 digest identifying this call.
+    """
+    raw = orjson.dumps(
+        {"m": model, "t": 0, "seed": seed, "tpl": template_version, "in": payload}, option=orjson.OPT_SORT_KEYS
+    )
+    return hashlib.sha256(raw).hexdigest()
+
+
+class DiskCache:
+    """
+    SQLite-backed CacheBackend that persists results across server restarts.
+    """
+
+    def __init__(self, path: str = ".llm_cache/cache.sqlite"):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at < time.time():
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return orjson.loads(value)
+
+    def _get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        found = {}
+        expired = []
+        now = time.time()
+        with self._lock:
+            # Chunked to stay under SQLite's limit on bound parameters per statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value, expires_at FROM cache WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, value, expires_at in rows:
+                    if expires_at is not None and expires_at < now:
+                        expired.append((key,))
+                    else:
+                        found[key] = orjson.loads(value)
+            if expired:
+                self._conn.executemany("DELETE FROM cache WHERE key = ?", expired)
+                self._conn.commit()
+        return [found.get(key) for key in keys]
+
+    def _set(self, key: str, value: Any, ttl: Optional[int]) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, orjson.dumps(value), expires_at),
+            )
+            self._conn.commit()
+
+    def _set_many(self, items: List[Tuple[str, Any]], ttl: Optional[int]) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                [(key, orjson.dumps(value), expires_at) for key, value in items],
+            )
+            self._conn.commit()
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await asyncio.to_thread(self._get, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """
+        Looks up all keys with one query and one thread hop; misses come back as None.
+        """
+        values = await asyncio.to_thread(self._get_many, keys)
+        found = sum(value is not None for value in values)
+        self.hits += found
+        self.misses += len(values) - found
+        return values
+
+    async def set_many(self, items: List[Tuple[str, Any]], ttl: Optional[int] = None) -> None:
+        """
+        Stores all (key, value) pairs in a single transaction.
+        """
+        if items:
+            await asyncio.to_thread(self._set_many, items, ttl)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class SemanticCache:
+    """
+    FAISS-backed nearest-neighbour cache that reuses results for near-duplicate inputs.
+
+    Embeddings are L2-normalized, so inner product on an IndexFlatIP is cosine similarity.
+    The persisted index is tagged with `version` and discarded on load if it was built
+    under a different one (e.g. another model, seed or prompt).
+    """
+
+    def __init__(
+        self, path: str = ".llm_cache/semantic", version: str = "", dim: int = 1536, threshold: float = 0.95
+    ):
+        self.index_path = path + ".faiss"
+        self.values_path = path + ".json"
+        self.version = version
+        self.threshold = threshold
+        self.index = faiss.IndexFlatIP(dim)
+        self.values: List[Any] = []
+        if os.path.exists(self.index_path) and os.path.exists(self.values_path):
+            with open(self.values_path, "rb") as f:
+                stored = orjson.loads(f.read())
+            if isinstance(stored, dict) and stored.get("version") == version:
+                index = faiss.read_index(self.index_path)
+                # The two files are saved separately; only reuse them if they still agree
+                if index.ntotal == len(stored["values"]):
+                    self.index = index
+                    self.values = stored["values"]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embeddings: List[List[float]]) -> np.ndarray:
+        vectors = np.asarray(embeddings, dtype="float32")
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def lookup(self, embedding: List[float]) -> Optional[Tuple[Any, float]]:
+        """
+        Returns the cached value and its similarity if the nearest neighbour
+        is at least `threshold` similar, otherwise None.
+        """
+        return self.lookup_many([embedding])[0]
+
+    def lookup_many(self, embeddings: List[List[float]]) -> List[Optional[Tuple[Any, float]]]:
+        """
+        Vectorized `lookup`: searches all embeddings against the index in a single call.
+        """
+        matches: List[Optional[Tuple[Any, float]]] = [None] * len(embeddings)
+        if embeddings and self.index.ntotal > 0:
+            scores, ids = self.index.search(self._normalize(embeddings), 1)
+            for i, (similarity, idx) in enumerate(zip(scores[:, 0], ids[:, 0])):
+                if idx != -1 and similarity >= self.threshold:
+                    matches[i] = self.values[int(idx)], float(similarity)
+        found = sum(match is not None for match in matches)
+        self.hits += found
+        self.misses += len(embeddings) - found
+        return matches
+
+    def add(self, embedding: List[float], value: Any) -> None:
+        self.add_many([embedding], [value])
+
+    def add_many(self, embeddings: List[List[float]], values: List[Any]) -> None:
+        if embeddings:
+            self.index.add(self._normalize(embeddings))
+            self.values.extend(values)
+
+    def save(self) -> None:
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Each file is written to a temporary path and swapped in, so a crash never leaves
+        # a half-written file behind; __init__ discards a mismatched pair
+        faiss.write_index(self.index, self.index_path + ".tmp")
+        with open(self.values_path + ".tmp", "wb") as f:
+            f.write(orjson.dumps({"version": self.version, "values": self.values}))
+        os.replace(self.index_path + ".tmp", self.index_path)
+        os.replace(self.values_path + ".tmp", self.values_path)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": self.index.ntotal}
@@ -1,14 +1,22 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Request, Response
+from fastapi.responses import ORJSONResponse
+from langchain_core.messages import HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain_core.output_parsers import PydanticOutputParser, JsonOutputParser
 from pydantic import BaseModel, Field
-import json
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+import asyncio
+import httpx
+import orjson
 import os
 from dotenv import load_dotenv
 
+from llm_cache import DiskCache, SemanticCache, make_cache_key, template_hash
+
 load_dotenv()  # Load environment variables from .env file
 
 openai_api_key = os.environ.get("OPENAI_API_KEY")
@@ -18,11 +26,61 @@ if openai_api_key:
 else:
     print("Warning: OPENAI_API_KEY not found in .env file.")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+MODEL_NAME = "gpt-4.1-mini"
+# Fixed seed so temperature=0 responses are reproducible and safe to cache
+LLM_SEED = 42
+CACHE_TTL = 7 * 24 * 60 * 60  # One week, in seconds
+# Request limits, tuned to the OpenAI RPM quota of the account in use
+CLIENT_RATE_LIMIT = os.environ.get("CLIENT_RATE_LIMIT", "60/minute")
+GLOBAL_RATE_LIMIT = os.environ.get("GLOBAL_RATE_LIMIT", "500/minute")
+# slowapi counts a batch as a single request, so its size is capped to keep one POST from
+# queueing an unbounded number of LLM calls; matches BATCH_SIZE in categorize_data.py
+BATCH_MAX_ITEMS = 32
+
+# headers_enabled makes 429s carry Retry-After, which categorize_data.py waits for.
+# Endpoints that return a model rather than a Response need a `response` parameter for it.
+limiter = Limiter(key_func=get_remote_address, headers_enabled=True)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+# Shared by every client, unlike the per-IP limit
+global_limit = limiter.shared_limit(GLOBAL_RATE_LIMIT, scope="llm", key_func=lambda *args: "global")
+
+# Caps the number of LLM calls in flight across all requests
+llm_semaphore = asyncio.Semaphore(int(os.environ.get("LLM_MAX_INFLIGHT", 16)))
+
+# One pooled HTTP/2 client shared by the chat model and embeddings, so connections
+# to the OpenAI API stay warm between requests
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=60),
+    timeout=httpx.Timeout(60.0),
+    http2=True,
+)
+
+llm = ChatOpenAI(model=MODEL_NAME, temperature=0, seed=LLM_SEED, http_async_client=http_client)
+embeddings = OpenAIEmbeddings(http_async_client=http_client)
+llm_cache = DiskCache(os.environ.get("LLM_CACHE_PATH", ".llm_cache/cache.sqlite"))
+
+
+@app.on_event("shutdown")
+def save_semantic_cache():
+    category_semantic_cache.save()
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+
+async def run_chain(chain, inputs: Any) -> Any:
+    """
+    Invokes a chain (or a bare structured-output model with pre-rendered messages)
+    while holding llm_semaphore, so the cap covers the LLM call itself.
+    """
+    async with llm_semaphore:
+        return await chain.ainvoke(inputs)
 
-llm = ChatOpenAI(model="gpt-4.1-mini", temperature=0)
-embeddings = OpenAIEmbeddings()
-json_output_parser = JsonOutputParser()
 
 class SentimentDetail(BaseModel):
     strength: int = Field(ge=0, le=100, description="Sentiment strength between 0 and 100")
@@ -41,7 +99,8 @@ class SentimentInput(BaseModel):
     last_news: str
 
 
-prompt_sentiment = ChatPromptTemplate.from_template("""
+# Rendered with str.format rather than a ChatPromptTemplate, like prompt_category below.
+prompt_sentiment = """
     Analyze the sentiment expressed in these recent tweets about an event in Lublin.
 
     Event: {title}
@@ -51,27 +110,19 @@ prompt_sentiment = ChatPromptTemplate.from_template("""
     Recent Tweets:
     {last_news}
 
-    Provide a sentiment analysis with the following structure:
-    {{
-        "agitation": {{
-            "strength": <0-100>,
-            "detectedEmotions": ["emotion1", "emotion2", ...]
-        }},
-        "neutral": {{
-            "strength": <0-100>,
-            "detectedEmotions": ["emotion1", "emotion2", ...]
-        }},
-        "positive": {{
-            "strength": <0-100>,
-            "detectedEmotions": ["emotion1", "emotion2", ...]
-        }}
-    }}
-
-    Ensure the JSON is valid and the strengths across all categories sum to 100.
+    Rate the agitation, neutral and positive sentiment, listing the emotions detected for each.
+    Ensure the strengths across all categories sum to 100.
     """
-)
-sentiment_parser = PydanticOutputParser(pydantic_object=Sentiment)
-sentiment_chain = prompt_sentiment | llm | sentiment_parser
+
+
+def render_sentiment_prompt(inputs: Dict[str, str]) -> List[HumanMessage]:
+    return [HumanMessage(content=prompt_sentiment.format(
+        title=inputs["title"], description=inputs["description"], last_news=inputs["last_news"]
+    ))]
+
+
+sentiment_llm = llm.with_structured_output(Sentiment)
+sentiment_version = template_hash(prompt_sentiment, Sentiment)
 
 
 class NewEventInput(BaseModel):
@@ -79,8 +130,8 @@ class NewEventInput(BaseModel):
 
 
 class NewEventOutput(BaseModel):
-    title: str
-    description: str
+    title: str = Field(description="Short summary of the news event")
+    description: str = Field(description="Concise description of the news event")
 
 
 prompt_new_event = ChatPromptTemplate.from_template(
@@ -90,18 +141,11 @@ You are an expert in creating concise titles and descriptions for news articles
 Here is the unrelated News article:
 {news_content}
 
-Based on this news article, create a short, descriptive title and a concise description that captures the essence of the event.
-
-Return your response as a JSON object with the following format in Polish language:
-{{
-    "title": "Short summary of the news event",
-    "description": "Concise description of the news event."
-}}
-
-Strictly follow the JSON format in your response. Do not include any additional text or explanations.
+Based on this news article, create a short, descriptive title and a concise description that captures the essence of the event, in Polish language.
 """
 )
-new_event_chain = prompt_new_event | llm | json_output_parser
+new_event_chain = prompt_new_event | llm.with_structured_output(NewEventOutput)
+new_event_version = template_hash(prompt_new_event.messages[0].prompt.template, NewEventOutput)
 
 
 class VerificationInput(BaseModel):
@@ -110,9 +154,15 @@ class VerificationInput(BaseModel):
 
 
 class VerificationOutput(BaseModel):
-    comparison: str
-    correctness: str
-    public_announcement: str
+    comparison: str = Field(description="Detailed comparison of the event and authority information")
+    correctness: str = Field(
+        description="Assessment of the event information's correctness "
+        "(e.g. \"Correct\", \"Incorrect\", \"Partially Correct\", \"Cannot Determine\")"
+    )
+    public_announcement: str = Field(
+        description="Suggested public response to the event information, including a summary of the event, "
+        "a summary of the authority information, and an assessment of the correctness of the event information"
+    )
 
 
 prompt_verification = ChatPromptTemplate.from_template(
@@ -130,17 +180,11 @@ Here is the Event information:
 Here is the Official information from authorities:
 {authority_announcement}
 
-Provide your analysis in a JSON object with the following structure in Polish language:
-{{
-    "comparison": "Detailed comparison of the event and authority information.",
-    "correctness": "Assessment of the event information's correctness (e.g., \\"Correct\\", \\"Incorrect\\", \\"Partially Correct\\", \\"Cannot Determine\\").",
-    "public_announcement": "Suggested public response to the event information, including a summary of the event, a summary of the authority information, and an assessment of the correctness of the event information."
-}}
-
-Strictly follow the JSON format. Do not include any extra text.
+Provide your analysis in Polish language.
 """
 )
-verification_chain = prompt_verification | llm | json_output_parser
+verification_chain = prompt_verification | llm.with_structured_output(VerificationOutput)
+verification_version = template_hash(prompt_verification.messages[0].prompt.template, VerificationOutput)
 
 
 class CategoryOutput(BaseModel):
@@ -153,74 +197,193 @@ class CategoryInput(BaseModel):
     description: str
 
 
-prompt_category = ChatPromptTemplate.from_template(
-    """
+# Rendered with str.format on the event loop instead of through a ChatPromptTemplate:
+# /categorize_event is the hottest endpoint and this skips the template machinery
+# (and its callback run) on every call.
+prompt_category = """
 You are an expert in categorizing events based on their title and description.
 Given the following event title and description, determine the most appropriate category for this event in Polish Language.
 Also, provide a confidence score between 0 and 1 for your categorization.
 
 Title: {title}
 Description: {description}
+"""
 
-Return your response as a JSON object with the following format:
-{{
-    "category": "The determined category",
-    "confidence": <0.0-1.0>
-}}
 
-Strictly follow the JSON format. Do not include any additional text or explanations.
-"""
+def render_category_prompt(inputs: Dict[str, str]) -> List[HumanMessage]:
+    return [HumanMessage(content=prompt_category.format(title=inputs["title"], description=inputs["description"]))]
+
+
+category_llm = llm.with_structured_output(CategoryOutput)
+category_version = template_hash(prompt_category, CategoryOutput)
+
+# Only categorizations go through the semantic cache: they are informational labels that
+# are safe to share between re-phrased events, unlike sentiment or verification results.
+# Like the exact cache, it is invalidated by a change of model, seed, prompt or embedding model.
+category_semantic_cache = SemanticCache(
+    os.environ.get("SEMANTIC_CACHE_PATH", ".llm_cache/category"),
+    version=f"{MODEL_NAME}|{LLM_SEED}|{category_version}|{embeddings.model}",
+    threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)),
 )
-category_parser = PydanticOutputParser(pydantic_object=CategoryOutput)
-category_chain = prompt_category | llm | category_parser
+
+
+class CategoryBatchInput(BaseModel):
+    items: List[CategoryInput] = Field(max_length=BATCH_MAX_ITEMS)
+
+
+class CategoryBatchOutput(BaseModel):
+    items: List[Optional[CategoryOutput]] = Field(description="One result per input item, null where it failed")
 
 
 @app.post("/categorize_event", response_model=CategoryOutput)
-async def categorize_event(category_input: CategoryInput = Body(...)):
+@global_limit
+@limiter.limit(CLIENT_RATE_LIMIT)
+async def categorize_event(request: Request, category_input: CategoryInput = Body(...)):
     """
     Categorizes an event based on its title and description.
+
+    Results are returned as an ORJSONResponse: they are already validated
+    CategoryOutput data, so FastAPI's response_model validation is skipped.
+    """
+    try:
+        inputs = {"title": category_input.title, "description": category_input.description}
+        key = make_cache_key(MODEL_NAME, LLM_SEED, category_version, inputs)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            return ORJSONResponse(cached)
+
+        embedding = await embeddings.aembed_query(category_input.title + "\n" + category_input.description)
+        match = category_semantic_cache.lookup(embedding)
+        if match is not None:
+            similar, similarity = match
+            return ORJSONResponse({"category": similar["category"], "confidence": similar["confidence"] * similarity})
+
+        result = await run_chain(category_llm, render_category_prompt(inputs))
+        output = result.model_dump()
+        await llm_cache.set(key, output, ttl=CACHE_TTL)
+        category_semantic_cache.add(embedding, output)
+        return ORJSONResponse(output)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/categorize_events_batch", response_model=CategoryBatchOutput)
+@global_limit
+@limiter.limit(CLIENT_RATE_LIMIT)
+async def categorize_events_batch(request: Request, batch_input: CategoryBatchInput = Body(...)):
+    """
+    Categorizes many events in one request, consulting the exact and semantic caches
+    in bulk and running only the remaining ones concurrently. An item whose LLM call
+    fails comes back as null without failing the rest of the batch.
+    Like /categorize_event, it skips response_model validation.
     """
     try:
-        result = category_chain.invoke(category_input.model_dump())
-        return result
+        inputs = [{"title": item.title, "description": item.description} for item in batch_input.items]
+        keys = [make_cache_key(MODEL_NAME, LLM_SEED, category_version, item) for item in inputs]
+        results: List[Any] = await llm_cache.get_many(keys)
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            # All exact-cache misses are embedded in one API call and searched in one FAISS query
+            vectors = await embeddings.aembed_documents(
+                [inputs[i]["title"] + "\n" + inputs[i]["description"] for i in missing]
+            )
+            unmatched = []
+            for i, vector, match in zip(missing, vectors, category_semantic_cache.lookup_many(vectors)):
+                if match is not None:
+                    similar, similarity = match
+                    results[i] = {"category": similar["category"], "confidence": similar["confidence"] * similarity}
+                else:
+                    unmatched.append((i, vector))
+
+            fresh = await asyncio.gather(
+                *(run_chain(category_llm, render_category_prompt(inputs[i])) for i, _ in unmatched),
+                return_exceptions=True,
+            )
+            succeeded = []
+            for (i, vector), result in zip(unmatched, fresh):
+                if isinstance(result, Exception):
+                    print(f"Error categorizing event '{inputs[i]['title']}': {result}")
+                    continue
+                results[i] = result.model_dump()
+                succeeded.append((i, vector))
+            await llm_cache.set_many([(keys[i], results[i]) for i, _ in succeeded], ttl=CACHE_TTL)
+            category_semantic_cache.add_many([vector for _, vector in succeeded], [results[i] for i, _ in succeeded])
+        return ORJSONResponse({"items": results})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/analyze_sentiment", response_model=Sentiment)
-async def analyze_sentiment(sentiment_input: SentimentInput = Body(...)):
+@global_limit
+@limiter.limit(CLIENT_RATE_LIMIT)
+async def analyze_sentiment(request: Request, sentiment_input: SentimentInput = Body(...)):
     """
     Analyzes the sentiment of recent news about an event in Lublin.
+
+    Like /categorize_event, it skips response_model validation.
     """
     try:
-        result = sentiment_chain.invoke(sentiment_input.model_dump())
-        return result
+        key = make_cache_key(MODEL_NAME, LLM_SEED, sentiment_version, sentiment_input.model_dump())
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            return ORJSONResponse(cached)
+        result = await run_chain(sentiment_llm, render_sentiment_prompt(sentiment_input.model_dump()))
+        output = result.model_dump()
+        await llm_cache.set(key, output, ttl=CACHE_TTL)
+        return ORJSONResponse(output)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/create_new_event", response_model=NewEventOutput)
-async def create_new_event_endpoint(new_event_input: NewEventInput = Body(...)):
+@global_limit
+@limiter.limit(CLIENT_RATE_LIMIT)
+async def create_new_event_endpoint(
+    request: Request, response: Response, new_event_input: NewEventInput = Body(...)
+):
     """
     Creates a concise title and description for a news article.
     """
     try:
-        result = new_event_chain.invoke({"news_content": new_event_input.news_content})
-        return NewEventOutput(**result)
+        key = make_cache_key(MODEL_NAME, LLM_SEED, new_event_version, new_event_input.model_dump())
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            return NewEventOutput(**cached)
+        output = await run_chain(new_event_chain, {"news_content": new_event_input.news_content})
+        await llm_cache.set(key, output.model_dump(), ttl=CACHE_TTL)
+        return output
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/verify_event_information", response_model=VerificationOutput)
-async def verify_event_information_endpoint(verification_input: VerificationInput = Body(...)):
+@global_limit
+@limiter.limit(CLIENT_RATE_LIMIT)
+async def verify_event_information_endpoint(
+    request: Request, response: Response, verification_input: VerificationInput = Body(...)
+):
     """
     Verifies event information against official information from authorities.
     """
     try:
-        result = verification_chain.invoke({
-            "event_info": json.dumps(verification_input.event_info, ensure_ascii=False),
+        key = make_cache_key(MODEL_NAME, LLM_SEED, verification_version, verification_input.model_dump())
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            return VerificationOutput(**cached)
+        output = await run_chain(verification_chain, {
+            "event_info": orjson.dumps(verification_input.event_info).decode(),
             "authority_announcement": verification_input.authority_announcement
         })
-        return VerificationOutput(**result)
+        await llm_cache.set(key, output.model_dump(), ttl=CACHE_TTL)
+        return output
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/cache_stats")
+async def cache_stats():
+    """
+    Returns hit/miss counters for the LLM result caches.
+    """
+    return {"exact": llm_cache.stats(), "semantic": category_semantic_cache.stats()}